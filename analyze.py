@@ -3,9 +3,14 @@ This module contains functions used to analyze the prepared FMR and CPI data.
 """
 
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import transformData
 
+# Fields of the FMR data that can be analyzed.
+ACCEPTABLE_FIELDS = frozenset({'Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom',
+                               'Mean_Rent'})
+
 
 def lag_calculator(df: pd.DataFrame, field_to_analyze: str, estimated_lag=2, use_estimate=False) -> None:
     """
@@ -29,9 +34,8 @@ def lag_calculator(df: pd.DataFrame, field_to_analyze: str, estimated_lag=2, use
     """
 
     # Checking if the provided field is acceptable
-    acceptable_values = ['Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom', 'Mean_Rent']
-    if field_to_analyze not in acceptable_values:
-        raise ValueError(f'Field {field_to_analyze} is not acceptable\n Valid options are {acceptable_values}')
+    if field_to_analyze not in ACCEPTABLE_FIELDS:
+        raise ValueError(f'Field {field_to_analyze} is not acceptable\n Valid options are {sorted(ACCEPTABLE_FIELDS)}')
     df = df[[field_to_analyze, 'CPI']]
 
     # There might be a correlation between percentage change in FMR and CPI, but it might not necessarily be
@@ -51,11 +55,12 @@ def lag_calculator(df: pd.DataFrame, field_to_analyze: str, estimated_lag=2, use
         data_s = data.copy()
         data_s['CPI'] = data_s['CPI'].shift(time_lag)
         data_s.rename(columns={'CPI': 'CPI Shifted'}, inplace=True)
-        data_s[field_to_analyze].plot.line(figsize=(10, 6), linewidth=1, color='orange', legend=True)
-        data_s['CPI Shifted'].plot.line(figsize=(10, 6), linewidth=4, color='green', legend=True)
-        data['CPI'].plot.line(figsize=(10, 6), linewidth=1, color='red', linestyle='dashed', legend=True)
-        plt.xlabel('Year')
-        plt.ylabel('Percentage Change')
+        fig, ax = plt.subplots(figsize=(10, 6))  # drawing all the lines on a single set of axes
+        data_s[field_to_analyze].plot.line(ax=ax, linewidth=1, color='orange', legend=True)
+        data_s['CPI Shifted'].plot.line(ax=ax, linewidth=4, color='green', legend=True)
+        data['CPI'].plot.line(ax=ax, linewidth=1, color='red', linestyle='dashed', legend=True)
+        ax.set_xlabel('Year')
+        ax.set_ylabel('Percentage Change')
         plt.show()
 
     # If an estimated lag value is provided, skip the calculation and plot the graph
@@ -63,12 +68,22 @@ def lag_calculator(df: pd.DataFrame, field_to_analyze: str, estimated_lag=2, use
         plot_lag(df, estimated_lag)
 
     else:
+        x = df[field_to_analyze].to_numpy(dtype='float64', na_value=np.nan)
+        y = df['CPI'].to_numpy(dtype='float64', na_value=np.nan)
         best_corr = 0
         best_lag = 0
         for lag in range(0, 4):
-            shift_data = df.copy()
-            shift_data['CPI'] = shift_data['CPI'].shift(lag)
-            corr = shift_data.corr().loc[field_to_analyze, 'CPI']
+            # Shifting CPI by slicing the arrays, which pairs every FMR value with the CPI 'lag' years before it,
+            # without copying the data.
+            x_lag = x[lag:]
+            y_lag = y[:len(y) - lag]
+            valid = ~(np.isnan(x_lag) | np.isnan(y_lag))
+            # Like 'DataFrame.corr', the correlation is NaN when there are less than two pairs of values, or when one
+            # of the series is constant, without any numpy warnings being raised for it.
+            corr = np.nan
+            if valid.sum() >= 2:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    corr = np.corrcoef(x_lag[valid], y_lag[valid])[0, 1]
             if corr > best_corr:
                 best_corr = corr
                 best_lag = lag
@@ -112,10 +127,15 @@ def zipcodes_trends(df: pd.DataFrame, field_to_analyze: str) -> pd.DataFrame:
     139   92672          0          0      0          0.062255
     ...
     [140 rows x 5 columns]
+    >>> growth = [1.05] * 9 + [1.5]  # the last zipcode grows much faster than the others, every year
+    >>> test_data = pd.DataFrame({'ZIPCODE': [str(90001 + i) for i in range(10)] * 3, 'Date': pd.to_datetime(['2020-10-01', '2021-10-01', '2022-10-01']).repeat(10), 'Mean_Rent': [1000 * g ** year for year in range(3) for g in growth]})
+    >>> print(zipcodes_trends(test_data, 'Mean_Rent').head(2))
+      ZIPCODE  Above STD  Below STD  Total  Mean_growth_rate
+    0   90010          2          0      2              0.50
+    1   90001          0          0      0              0.05
 
     """
-    acceptable_values = ['Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom', 'Mean_Rent']
-    if field_to_analyze not in acceptable_values:
+    if field_to_analyze not in ACCEPTABLE_FIELDS:
         raise ValueError(f'Field {field_to_analyze} is not acceptable')
 
     # list of unique zip codes in the area:
@@ -125,38 +145,32 @@ def zipcodes_trends(df: pd.DataFrame, field_to_analyze: str) -> pd.DataFrame:
     df = df[['ZIPCODE', field_to_analyze, 'Date']]
 
     # Pivoting the dataframe to make zipcodes as the columns and date as the index, with FMR data as the values.
-    df_pivot = df.pivot(columns='ZIPCODE', index='Date', values=field_to_analyze)
-    df_pivot['Mean_Rent'] = df_pivot.mean(axis=1)  # calculating the mean rent for the metro area for every year
-    df_pivot = df_pivot.pct_change().dropna()   # calculating the percentage change in FMR
+    # The rest of the analysis is carried out on the underlying (years x zipcodes) float32 matrix, so that every
+    # step is a single numpy pass instead of a new dataframe.
+    fmr = (df.pivot(columns='ZIPCODE', index='Date', values=field_to_analyze)[zips]
+           .to_numpy(dtype='float32', na_value=np.nan))
+    metro_fmr = np.nanmean(fmr, axis=1)  # calculating the mean rent for the metro area for every year
+
+    # calculating the percentage change in FMR, and dropping the years with missing values.
+    zip_growth = fmr[1:] / fmr[:-1] - 1
+    metro_growth = metro_fmr[1:] / metro_fmr[:-1] - 1
+    complete = ~(np.isnan(zip_growth).any(axis=1) | np.isnan(metro_growth))
+    zip_growth = zip_growth[complete]
+    metro_growth = metro_growth[complete]
+
     # calculating the standard deviation in FMR value for each year
-    df_pivot['STD'] = df_pivot.drop(columns=['Mean_Rent']).std(axis=1)
-    df_pivot['Upper_Limit'] = df_pivot['Mean_Rent'] + (
-            2 * df_pivot['STD'])
-    df_pivot['Lower_Limit'] = df_pivot['Mean_Rent'] - (
-            2 * df_pivot['STD'])
-    deviation = list()
-
-    # Identifying anomalies
-    for z in zips:
-        temp = dict()
-        upper = df_pivot[z] >= df_pivot['Upper_Limit']
-        lower = df_pivot[z] <= df_pivot['Lower_Limit']
-        upper_true_count = 0
-        lower_true_count = 0
-        if upper.value_counts().shape[0] == 2:
-            upper_true_count = upper.value_counts().iloc[1]
-        if lower.value_counts().shape[0] == 2:
-            lower_true_count = lower.value_counts().iloc[1]
-        total_count = upper_true_count + lower_true_count
-        temp['ZIPCODE'] = z
-        temp['Above STD'] = upper_true_count
-        temp['Below STD'] = lower_true_count
-        temp['Total'] = total_count
-        temp['Mean_growth_rate'] = df_pivot[z].mean()
-        deviation.append(temp)
-
-    dev = (pd.DataFrame(deviation).
-           astype(dtype={'ZIPCODE': 'string', 'Above STD': 'Int8', 'Below STD': 'Int8', 'Total': 'Int8'}))
+    std = zip_growth.std(axis=1, ddof=1)
+    upper_limit = (metro_growth + 2 * std)[:, None]
+    lower_limit = (metro_growth - 2 * std)[:, None]
+
+    # Identifying anomalies.
+    # Comparing every zipcode against the yearly limits at once, instead of looping over the zipcodes.
+    above = np.count_nonzero(zip_growth >= upper_limit, axis=0)
+    below = np.count_nonzero(zip_growth <= lower_limit, axis=0)
+
+    dev = (pd.DataFrame({'ZIPCODE': zips, 'Above STD': above, 'Below STD': below, 'Total': above + below,
+                         'Mean_growth_rate': zip_growth.mean(axis=0)}).
+           astype(dtype={'ZIPCODE': 'string', 'Above STD': 'int16', 'Below STD': 'int16', 'Total': 'int16'}))
 
     return dev.sort_values(['Total', 'Above STD', 'Below STD'], ascending=False).reset_index(drop=True)
 
@@ -186,12 +200,13 @@ def plot_zipcode_trends(df: pd.DataFrame, field_to_analyze: str, zipcode: str,
 
     merge_zip = merge_zip.pct_change()
     merge_zip['CPI'] = merge_zip['CPI'].shift(2)
-    merge_zip[field_to_analyze + '_zip'].plot.line(figsize=(10, 6), linewidth=2, color='orange', legend=True)
-    merge_zip[field_to_analyze + '_metro'].plot.line(figsize=(10, 6), linewidth=1, color='red', legend=True)
-    merge_zip['CPI'].plot.line(figsize=(10, 6), linewidth=3, color='green', legend=True)
-    plt.xlabel('Year')
-    plt.ylabel('Percentage Change')
-    plt.legend(loc='center left', bbox_to_anchor=(1.0, 0.5), fontsize=9)
+    fig, ax = plt.subplots(figsize=(10, 6))  # drawing all the lines on a single set of axes
+    merge_zip[field_to_analyze + '_zip'].plot.line(ax=ax, linewidth=2, color='orange', legend=True)
+    merge_zip[field_to_analyze + '_metro'].plot.line(ax=ax, linewidth=1, color='red', legend=True)
+    merge_zip['CPI'].plot.line(ax=ax, linewidth=3, color='green', legend=True)
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Percentage Change')
+    ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5), fontsize=9)
     plt.show()
 
 
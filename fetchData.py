@@ -4,11 +4,97 @@ This Module uses the huduser.gov API to fetch Free Market rates
 """
 
 from configparser import ConfigParser
+import functools
+import hashlib
+import inspect
+import os
+import tempfile
 import requests
 import pandas as pd
+import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 import json
-from datetime import datetime
+
+
+# Directory in which the dataframes returned by the 'disk_cache' decorated functions are stored.
+CACHE_DIRECTORY = 'Data/Cache'
+
+
+def disk_cache(ttl_days: int = 7):
+    """
+    Decorator that stores the dataframe returned by a function as a parquet file in the 'CACHE_DIRECTORY', and
+    reuses it for the same arguments instead of calling the function again. A cached file is refreshed once it is
+    older than 'ttl_days', or older than any of the input files passed as arguments.
+
+    :param ttl_days: Number of days for which the cached dataframe is used.
+    :return: Decorator for functions that return a dataframe.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Binding the arguments to the function's parameters along with their defaults, so that the same call made
+            # with positional or keyword arguments, or relying on a default input file, uses the same cached file.
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = repr(sorted(bound.arguments.items()))
+            cache_file = os.path.join(CACHE_DIRECTORY, func.__name__ + '_'
+                                      + hashlib.sha256(arguments.encode()).hexdigest()[:16] + '.parquet')
+
+            if os.path.exists(cache_file):
+                cache_time = os.path.getmtime(cache_file)
+                input_files = [arg for arg in bound.arguments.values() if isinstance(arg, str) and os.path.isfile(arg)]
+                if (time.time() - cache_time < ttl_days * 24 * 60 * 60
+                        and all(os.path.getmtime(file) <= cache_time for file in input_files)):
+                    try:
+                        return pd.read_parquet(cache_file)
+                    except (OSError, ValueError):
+                        # A cached file that cannot be read, such as one left half written by an interrupted run,
+                        # is treated as missing, and the function is called again to replace it.
+                        pass
+
+            data = func(*args, **kwargs)
+
+            # The dataframe is written to a temporary file first and then moved in place, so that an interrupted
+            # write never leaves a partial file at the cache path.
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            handle, temp_file = tempfile.mkstemp(dir=CACHE_DIRECTORY, suffix='.tmp')
+            os.close(handle)
+            try:
+                data.to_parquet(temp_file, index=False)
+                os.replace(temp_file, cache_file)
+            except BaseException:
+                os.remove(temp_file)
+                raise
+            return data
+
+        return wrapper
+
+    return decorator
+
+
+@functools.lru_cache(maxsize=4)
+def load_api_keys(api_config: str) -> dict:
+    """
+    Reads the BLS and HUD API keys from the API configuration file.
+    The keys are cached for each configuration file, so the file is only parsed once per session.
+
+    :param api_config: API configuration file path and name
+    :return: Dictionary containing the 'BLS' and 'HUD' API keys
+
+    >>> load_api_keys(api_config='Data/Test Data/API_Config_test.ini')
+    {'BLS': 'efgh', 'HUD': 'abcd'}
+    >>> load_api_keys(api_config='Data/Test Data/API_Config.ini')    # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    KeyError: 'API_Key'
+    """
+
+    # https://www.youtube.com/watch?v=Gdw0-QGq-z0
+    config = ConfigParser()
+    config.read(api_config)
+    return {'BLS': config['API_Key']['BLS_key'], 'HUD': config['API_Key']['HUD_key']}
 
 
 def fetch_metro_cpi_bls(api_config: str, area_code: str, start_year: int, end_year: int) -> pd.DataFrame | None:
@@ -37,11 +123,7 @@ def fetch_metro_cpi_bls(api_config: str, area_code: str, start_year: int, end_ye
     Index(['01', '03', '05', '07', '09', '11'], dtype='object', name='Month')
     """
 
-    # https://www.youtube.com/watch?v=Gdw0-QGq-z0
-    config_file = api_config
-    config = ConfigParser()
-    config.read(config_file)
-    bls_key = config['API_Key']['BLS_key']
+    bls_key = load_api_keys(api_config)['BLS']
 
     # https://stackoverflow.com/questions/29931671/making-an-api-call-in-python-with-an-api-that-requires-a-bearer-token
     bls_base_url = 'https://api.bls.gov/publicAPI/v2/timeseries/data/'
@@ -66,15 +148,22 @@ def fetch_metro_cpi_bls(api_config: str, area_code: str, start_year: int, end_ye
         data = pd.DataFrame()
         for series in bls_response:
             temp = series['data']
-            data = pd.DataFrame(temp)
-            data.drop(columns=['periodName', 'footnotes'], inplace=True)
-            data['period'] = data['period'].apply(lambda x: x.replace('M', ''))
-            data.rename(columns={'period': 'Month'}, inplace=True)
-            data = data.pivot(columns='Month', index='year', values='value')
-            data = data.astype('Float32')
+            years = np.array([d['year'] for d in temp])
+            months = np.array([d['period'].replace('M', '') for d in temp])
+            values = np.array([d['value'] for d in temp], dtype='float32')
+
+            # Placing every value in a (year x month) matrix, directly at the position of its year and month.
+            year_index, year_position = np.unique(years, return_inverse=True)
+            month_index, month_position = np.unique(months, return_inverse=True)
+            cpi = np.full((len(year_index), len(month_index)), np.nan, dtype='float32')
+            cpi[year_position, month_position] = values
+
+            data = pd.DataFrame(cpi, index=pd.Index(year_index.tolist(), name='year'),
+                                columns=pd.Index(month_index.tolist(), name='Month')).astype('Float32')
         return data
 
 
+@disk_cache(ttl_days=7)
 def get_bls_series_id(metro_code_file='Data/BLS/cu.area.txt',
                       series_id_prefix='CUUR', series_id_suffix='SA0') -> pd.DataFrame:
     """
@@ -95,34 +184,6 @@ def get_bls_series_id(metro_code_file='Data/BLS/cu.area.txt',
     3  CUURS49DSA0           Seattle-Tacoma-Bellevue         WA
     """
 
-    def area_parser(x: str) -> str:
-        """
-        Cleans the 'area_name' parameter to just give the area_name.
-
-        :param x: String to be cleaned
-        :return: Clean string
-        """
-        x = x.split(',')
-        if len(x) > 1:
-            return x[0].strip()
-        else:
-            x = x[0].split(' ')
-            return x[0].strip()
-
-    def state_parser(x: str):
-        """
-        Fetches the state name from the 'area_name' field
-
-        :param x: String containing the area and state name
-        :return: String containing the state name
-        """
-        x = x.split(',')
-        if len(x) > 1:
-            return x[1].strip()
-        else:
-            x = x[0].split(' ')
-            return x[1].strip()
-
     with open(metro_code_file, 'r') as f:
         skip_row = 1
         for line in f:
@@ -140,8 +201,14 @@ def get_bls_series_id(metro_code_file='Data/BLS/cu.area.txt',
     code.rename(columns={'area_name': 'old_area_name'}, inplace=True)
 
     code = code[code['old_area_name'].str.contains('Size Class A') != True].reset_index(drop=True)
-    code['area_name'] = code['old_area_name'].apply(lambda x: area_parser(x))
-    code['area_state'] = code['old_area_name'].apply(lambda x: state_parser(x))
+
+    # Splitting the 'area_name' field into the area name and the state name. The names are usually separated by a
+    # comma, like 'Boston-Cambridge-Newton, MA-NH', otherwise by a space, like 'Urban Alaska'.
+    split_comma = code['old_area_name'].str.split(',')
+    split_space = code['old_area_name'].str.split(' ')
+    has_comma = split_comma.str.len() > 1
+    code['area_name'] = split_comma.str[0].where(has_comma, split_space.str[0]).str.strip()
+    code['area_state'] = split_comma.str[1].where(has_comma, split_space.str[1]).str.strip()
     code.drop(['old_area_name'], axis=1, inplace=True)
 
     # https://www.bls.gov/help/hlpforma.htm#CU
@@ -150,6 +217,7 @@ def get_bls_series_id(metro_code_file='Data/BLS/cu.area.txt',
     return code
 
 
+@disk_cache(ttl_days=7)
 def get_metro_codes_hud(api_config: str) -> pd.DataFrame:
     """
     This function uses the HUD API to fetch a list of metro areas
@@ -166,10 +234,7 @@ def get_metro_codes_hud(api_config: str) -> pd.DataFrame:
     ...
     KeyError: 'API_Key'
     """
-    config_file = api_config
-    config = ConfigParser()
-    config.read(config_file)
-    hud_key = config['API_Key']['HUD_key']
+    hud_key = load_api_keys(api_config)['HUD']
 
     hud_base_url = 'https://www.huduser.gov/hudapi/public/fmr'
     hud_headers = {"Authorization": "Bearer " + hud_key}
@@ -181,24 +246,13 @@ def get_metro_codes_hud(api_config: str) -> pd.DataFrame:
     except KeyError as e:
         print(e)
 
-    def state_parser(x: str):
-        """
-        Fetches the state name from the 'area_name' field
-        :param x: String containing the area and state name
-        :return: String containing the state name
-        """
-        x = x.split(',')
-        if len(x) > 1:
-            x = x[1].split(' ')
-            return x[1].strip()
-        else:
-            return None
-
     metro = pd.DataFrame(list_metros)
     metro.drop(columns=['category'], inplace=True)
     metro.rename(columns={'area_name': 'old_area_name'}, inplace=True)
-    metro['area_name'] = metro['old_area_name'].apply(lambda x: x.split(',')[0].strip())
-    metro['area_state'] = metro['old_area_name'].apply(lambda x: state_parser(x))
+    # The 'area_name' field contains the area name and the state name, like 'Champaign-Urbana, IL MSA'
+    split_comma = metro['old_area_name'].str.split(',')
+    metro['area_name'] = split_comma.str[0].str.strip()
+    metro['area_state'] = split_comma.str[1].str.split(' ').str[1].str.strip()
     metro.drop(['old_area_name'], axis=1, inplace=True)
     metro = metro.astype({'area_name': 'string', 'area_state': 'string', 'cbsa_code': 'string'})
     return metro
@@ -229,47 +283,68 @@ def fetch_state_fmr_data(api_config: str, start_year: int, end_year: int, state_
     0  METRO16580M16580       544.0 2017-02-01
     1  METRO16580M16580       615.0 2018-02-01
     """
-    config_file = api_config
-    config = ConfigParser()
-    config.read(config_file)
-    hud_key = config['API_Key']['HUD_key']
+    hud_key = load_api_keys(api_config)['HUD']
 
     hud_base_url = 'https://www.huduser.gov/hudapi/public/fmr'
     hud_headers = {"Authorization": "Bearer " + hud_key}
     data_endpoint = '/statedata/'
 
-    year_data = list()
-    for year in range(start_year, end_year + 1):
-        try:
-            data = requests.get(url=hud_base_url + data_endpoint + state_code + '?year=' + str(year),
+    def fetch_year(year: int) -> list:
+        """
+        Inner function to fetch the FMRs of all the metro areas in the state for a single year.
+
+        :param year: Year for which the FMRs are fetched.
+        :return: List containing the FMRs of each metro area.
+        """
+        response = requests.get(url=hud_base_url + data_endpoint + state_code + '?year=' + str(year),
                                 headers=hud_headers)
-        except KeyError as e:
-            print(e)
-            return None
-        if data.status_code == 200:
-            if len(data.json()) == 0:
-                raise ValueError(f'No data found for state_code {state_code}, '
-                                 f'ensure you have entered the correct state code')
-            else:
-                add_data = data.json()['data']['metroareas']
-                for d in add_data:
-                    d['Date'] = data.json()['data']['year']
-                    del d['metro_name']
-                    del d['FMR Percentile']
-                    del d['smallarea_status']
-                    del d['statename']
-                    del d['statecode']
-                    year_data.append(d)
-        # https://www.huduser.gov/portal/dataset/api-terms-of-service.html
-        time.sleep(1.1)  # to ensure that there is at least 1 second gap between 2 API calls.
+        if response.status_code != 200:
+            return list()
+        data_json = response.json()
+        if len(data_json) == 0:
+            raise ValueError(f'No data found for state_code {state_code}, '
+                             f'ensure you have entered the correct state code')
+        add_data = data_json['data']['metroareas']
+        for d in add_data:
+            d['Date'] = data_json['data']['year']
+            del d['metro_name']
+            del d['FMR Percentile']
+            del d['smallarea_status']
+            del d['statename']
+            del d['statecode']
+        return add_data
+
+    try:
+        # The first year is fetched on its own, so that an invalid state code or a failed connection is reported
+        # after a single API call, instead of after the calls for all the years have been sent.
+        year_data = fetch_year(start_year)
+
+        # The requests for the remaining years are independent of each other, so they are sent from a thread pool.
+        # Only the start of the calls is spaced out to respect the API rate limit, the network round trips of
+        # consecutive years overlap instead of being waited on one after another. There is one thread for every
+        # year, so that each call starts as soon as it is submitted instead of waiting in the queue for a free
+        # thread, which could make two calls start back to back. Each call uses its own 'requests.get', as a
+        # session is not safe to share between threads.
+        responses = list()
+        with ThreadPoolExecutor(max_workers=max(1, end_year - start_year)) as executor:
+            for year in range(start_year + 1, end_year + 1):
+                # https://www.huduser.gov/portal/dataset/api-terms-of-service.html
+                time.sleep(1.1)  # to ensure that there is at least 1 second gap between 2 API calls.
+                responses.append(executor.submit(fetch_year, year))
+
+        for response in responses:
+            year_data.extend(response.result())
+    except KeyError as e:
+        print(e)
+        return None
 
     metro_data = pd.DataFrame(year_data)
     metro_data = metro_data.astype(
-        {'Date': 'string', 'code': 'string', 'Efficiency': 'Float32', 'One-Bedroom': 'Float32',
+        {'Date': 'string', 'code': 'category', 'Efficiency': 'Float32', 'One-Bedroom': 'Float32',
          'Two-Bedroom': 'Float32', 'Three-Bedroom': 'Float32', 'Four-Bedroom': 'Float32'})
 
-    metro_data['Date'] = (metro_data['Date'].
-                          apply(lambda x: datetime.strptime(str(implementation_month) + '-' + x, '%m-%Y')))
+    metro_data['Date'] = pd.to_datetime(str(implementation_month) + '-' + metro_data['Date'], format='%m-%Y',
+                                        cache=True)
     return metro_data
 
 
@@ -5,11 +5,47 @@ a dataset of FMR rates for all available zipcodes.
 """
 
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import glob
+import functools
+import hashlib
 import re
-from datetime import datetime
-import math
 import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from python_calamine import CalamineError
+from xlrd import XLRDError
+from xlrd.compdoc import CompDocError
+from zipfile import BadZipFile
+
+# Pattern of the year section in the small area FMR file names - 'fy' followed by the year.
+FY_PATTERN = re.compile(r'fy(\d{4})', re.IGNORECASE)
+
+# Over the years, the HUD department has reformated the way in which they release the small area data,
+# hence files from different years have different column names and formats. Form my observation, they
+# have stuck to a single from since 2018 (except 2020), so any new file that they would release could
+# also be processed using this module.
+COLUMN_VARIATION_1 = ['ZIP\nCode', 'SAFMR\n0BR', 'SAFMR\n1BR', 'SAFMR\n2BR', 'SAFMR\n3BR', 'SAFMR\n4BR']
+COLUMN_VARIATION_2 = ['zcta', 'safmr_0br', 'safmr_1br', 'safmr_2br', 'safmr_3br', 'safmr_4br']
+COLUMN_VARIATION_3 = ['zip_code', 'area_rent_br0', 'area_rent_br1', 'area_rent_br2', 'area_rent_br3', 'area_rent_br4']
+COLUMN_VARIATION_4 = ['zipcode', 'area_rent_br0', 'area_rent_br1', 'area_rent_br2', 'area_rent_br3', 'area_rent_br4']
+COLUMN_VARIATION_5 = ['ZIP', 'area_rent_br0', 'area_rent_br1', 'area_rent_br2', 'area_rent_br3', 'area_rent_br4']
+DATATYPES = ['category', 'Int16', 'Int16', 'Int16', 'Int16', 'Int16']  # FMRs are whole dollar amounts
+ACTUAL_COL_NAMES = ['ZIPCODE', 'Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom']
+
+# Columns to be read from a file, along with the datatype that each column is read as and the name it is renamed to.
+FileSchema = namedtuple('FileSchema', ['use_cols', 'dtype_map', 'rename_map'])
+SCHEMA_1, SCHEMA_2, SCHEMA_3, SCHEMA_4, SCHEMA_5 = [
+    FileSchema(use_cols, dict(zip(use_cols, DATATYPES)), dict(zip(use_cols, ACTUAL_COL_NAMES)))
+    for use_cols in [COLUMN_VARIATION_1, COLUMN_VARIATION_2, COLUMN_VARIATION_3, COLUMN_VARIATION_4,
+                     COLUMN_VARIATION_5]]
+
+# Schema used by the files of each year. Any year missing from this map uses 'SCHEMA_1' if it is 2018 or later,
+# and 'SCHEMA_5' if it is before 2014.
+SCHEMA_BY_YEAR = {2014: SCHEMA_5, 2015: SCHEMA_4, 2016: SCHEMA_3, 2017: SCHEMA_3, 2020: SCHEMA_2}
 
 
 def load_one_fmr_file(filename: str, path: str) -> pd.DataFrame:
@@ -22,63 +58,62 @@ def load_one_fmr_file(filename: str, path: str) -> pd.DataFrame:
     :return: dataframe containing the small area FMR rates for all zipcodes
     """
 
-    # Over the years, the HUD department has reformated the way in which they release the small area data,
-    # hence files from different years have different column names and formats. Form my observation, they
-    # have stuck to a single from since 2018 (except 2020), so any new file that they would release could
-    # also be processed using this function.
-    column_variation_1 = ['ZIP\nCode', 'SAFMR\n0BR', 'SAFMR\n1BR', 'SAFMR\n2BR', 'SAFMR\n3BR', 'SAFMR\n4BR']
-    column_variation_2 = ['zcta', 'safmr_0br', 'safmr_1br', 'safmr_2br', 'safmr_3br', 'safmr_4br']
-    column_variation_3 = ['zip_code', 'area_rent_br0', 'area_rent_br1', 'area_rent_br2', 'area_rent_br3',
-                          'area_rent_br4']
-    column_variation_4 = ['zipcode', 'area_rent_br0', 'area_rent_br1', 'area_rent_br2', 'area_rent_br3',
-                          'area_rent_br4']
-    column_variation_5 = ['ZIP', 'area_rent_br0', 'area_rent_br1', 'area_rent_br2', 'area_rent_br3', 'area_rent_br4']
-    datatypes = ['str', 'Float32', 'Float32', 'Float32', 'Float32', 'Float32']
-    actual_col_names = ['ZIPCODE', 'Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom']
-
     # extracting the year for which the file was released, using the file name.
     # I noticed that each file has a section contain year in the format - 'fy' followed by the year.
     # using this pattern to figure out the year of the file.
     # https://www.w3schools.com/python/python_regex.asp
-    string = filename.lower()
-    year = re.search('fy\d{4}', string=string).group()
-    year = int(re.sub('\D', '', year))
+    year = int(FY_PATTERN.search(filename).group(1))
 
     # based on the year of the file, using the relevant column names and mapping them to appropriate datatypes.
-    if year >= 2018 and year != 2020:
-        use_cols = column_variation_1
-        assign_data_type = dict(zip(use_cols, datatypes))
-        use_names = dict(zip(use_cols, actual_col_names))
-    elif year == 2020:
-        use_cols = column_variation_2
-        assign_data_type = dict(zip(use_cols, datatypes))
-        use_names = dict(zip(use_cols, actual_col_names))
-    elif 2016 <= year <= 2017:
-        use_cols = column_variation_3
-        assign_data_type = dict(zip(use_cols, datatypes))
-        use_names = dict(zip(use_cols, actual_col_names))
-    elif year == 2015:
-        use_cols = column_variation_4
-        assign_data_type = dict(zip(use_cols, datatypes))
-        use_names = dict(zip(use_cols, actual_col_names))
-    else:
-        use_cols = column_variation_5
-        assign_data_type = dict(zip(use_cols, datatypes))
-        use_names = dict(zip(use_cols, actual_col_names))
+    schema = SCHEMA_BY_YEAR.get(year, SCHEMA_1 if year >= 2018 else SCHEMA_5)
+
+    # Parsing the excel file is the slowest step, so the processed dataframe is cached as a parquet file in the
+    # '.cache' directory next to it. The cache is keyed on the file's modification time and size along with the
+    # columns and datatypes used to read it, so any change in them makes the file be parsed again.
+    file_path = os.path.join(path, filename)
+    cache_key = f'{filename}:{os.path.getmtime(file_path)}:{os.path.getsize(file_path)}:{schema.dtype_map}'
+    cache_path = os.path.join(path, '.cache', hashlib.sha256(cache_key.encode()).hexdigest()[:16] + '.parquet')
+    if os.path.exists(cache_path):
+        try:
+            return pd.read_parquet(cache_path)
+        except (OSError, ValueError):
+            # A cache file that cannot be read, such as one left half written by an interrupted run, is treated as
+            # missing, and the file is parsed again to replace it.
+            pass
 
     # Incase there is a file that does not match any of the above pattern, then the function will
     # raise a ValueError with an appropriate error message.
     df = pd.DataFrame()  # defining the dataframe to prevent 'variable may be referred before assignment' warning.
     try:
-        df = pd.read_excel(path + '/' + filename, usecols=use_cols, dtype=assign_data_type)
+        # calamine is a Rust based excel reader, which parses the sheets much faster than openpyxl and xlrd.
+        # For files that calamine is unable to parse, falling back to the reader pandas picks for the file's format,
+        # i.e. xlrd for the older '.xls' workbooks and openpyxl for the '.xlsx' ones.
+        try:
+            df = pd.read_excel(file_path, usecols=schema.use_cols, dtype=schema.dtype_map, engine='calamine')
+        except CalamineError:
+            df = pd.read_excel(file_path, usecols=schema.use_cols, dtype=schema.dtype_map)
     except ValueError:
         print('Column names do not match existing pattern')
-    df = df.rename(columns=use_names)
+    except (XLRDError, CompDocError, BadZipFile) as error:
+        print(f'Unable to read {filename}: {error}')
+    df = df.rename(columns=schema.rename_map)
 
     # aggregating the FMR values for multiple entries of a single zipcode
     df = common_zipcode_mean(df)
 
-    df['Date'] = datetime.strptime("10-" + str(year), '%m-%Y')  # converting the date column to datetime datatype.
+    df['Date'] = pd.Timestamp(year=year, month=10, day=1)  # FMRs of each year are implemented from October.
+
+    # The cache is written to a temporary file first and then moved in place, so that an interrupted write never
+    # leaves a partial file at the cache path.
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+    os.close(handle)
+    try:
+        df.to_parquet(temp_path, compression='zstd')
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
     return df
 
@@ -95,35 +130,31 @@ def load_all_fmr_files(file_directory='Data/HUD FMR') -> pd.DataFrame:
     # reads the file name of all the files present in the given directory
     fmr_file_name = glob.glob(file_directory + '/*.csv')
 
-    # defining the dataframe used in the 'for loop' below to prevent 'variable may be referred before assignment'
-    # warning.
-    df = pd.DataFrame()
-    df_zip = pd.DataFrame()
-
-    # calling the 'load_one_fmr_file' function to load each file in the directory and concat it with the 'df' dataframe.
-    for file in range(len(fmr_file_name)):
-
-        # For the very first file, instead of using concat, we can simply copy the contents loaded file.
-        # All files don't have the same number of zipcodes; hence it is possible that some zipcodes have
-        # missing data for certain years. To have consistent data for analysis, on zipcodes that have data
-        # for all the years is considered. This is achieved by having a separate dataframe (df_zip) only for
-        # zipcodes, and merging carrying out inner join on zipcodes for every year. Doing this will ensure that
-        # only the zipcodes that are common for every year will be present in the final dataset.
-        if df.shape[0] == 0:
-            df = load_one_fmr_file(filename=os.path.basename(fmr_file_name[file]), path=file_directory)
-            df_zip = pd.DataFrame(df['ZIPCODE'])
-        else:
-            data = load_one_fmr_file(filename=os.path.basename(fmr_file_name[file]), path=file_directory)
-            data_zip = pd.DataFrame(data['ZIPCODE'])
-            df = pd.concat([df, data], ignore_index=True)
-            df_zip = df_zip.merge(data_zip, how='inner', on='ZIPCODE')
-
-    # Doing inner joint on the two dataframes on 'zipcode' column to get only the common zipcodes over the years.
-    df_final = (pd.merge(df, df_zip, how='inner', on='ZIPCODE')
-                .sort_values(['Date', 'ZIPCODE'], ascending=True).reset_index(drop=True))
-
-    # adding cbsa_code for each zipcode to map the zipcodes to their metro areas.
-    df_final = merge_area_code_zipcode(df_final, file_directory)
+    # calling the 'load_one_fmr_file' function to load each file in the directory, and concatenating all of them
+    # at once instead of growing the 'df' dataframe one file at a time.
+    # Each file is independent of the others, so they are parsed in parallel, one process per file. There is no use
+    # in starting more processes than there are files, or cores.
+    with ProcessPoolExecutor(max_workers=max(1, min(os.cpu_count() or 1, len(fmr_file_name)))) as executor:
+        frames = list(executor.map(functools.partial(load_one_fmr_file, path=file_directory),
+                                   [os.path.basename(file) for file in fmr_file_name]))
+    df = pd.concat(frames, ignore_index=True)
+    # The zipcodes of each file have different categories, hence they are converted back to category after concat.
+    df['ZIPCODE'] = df['ZIPCODE'].astype('category')
+
+    # All files don't have the same number of zipcodes; hence it is possible that some zipcodes have
+    # missing data for certain years. To have consistent data for analysis, on zipcodes that have data
+    # for all the years is considered. This is achieved by intersecting the zipcodes of every year, which
+    # ensures that only the zipcodes that are common for every year will be present in the final dataset.
+    common_zips = functools.reduce(lambda a, b: a.intersection(b), (pd.Index(f['ZIPCODE']) for f in frames))
+
+    # Keeping only the common zipcodes over the years, using a hash lookup instead of an inner join.
+    # The sort runs on integer keys: ZIPCODE is a category (its categories are in sorted order, so sorting the codes
+    # matches sorting the zipcodes) and Date is an int64-backed datetime, hence no string comparisons are made.
+    df_final = df[df['ZIPCODE'].isin(common_zips)].sort_values(['Date', 'ZIPCODE'], ascending=True, ignore_index=True)
+
+    # adding cbsa_code for each zipcode to map the zipcodes to their metro areas, using the most recent file.
+    latest_file = max(fmr_file_name, key=lambda file: int(FY_PATTERN.search(os.path.basename(file)).group(1)))
+    df_final = merge_area_code_zipcode(df_final, latest_file)
 
     return df_final
 
@@ -150,49 +181,31 @@ def common_zipcode_mean(fmr_data: pd.DataFrame) -> pd.DataFrame:
     # Note: Column index number is used as this is processed dataframe whose layout does not depend on the downloaded
     # data
     cols = list(fmr_data.columns)
-    non_unique = fmr_data[[cols[0], cols[1]]].groupby(cols[0]).count()
-    zips = list(non_unique[non_unique[cols[1]] > 1].index)
-    for zipcode in zips:
-        temp = fmr_data[fmr_data[cols[0]] == zipcode]
-        mean = temp.mean(numeric_only=True).apply(lambda x: math.ceil(x))
-        fmr_data = fmr_data[fmr_data[cols[0]] != zipcode]
-        add = {cols[0]: zipcode, cols[1]: mean[cols[1]], cols[2]: mean[cols[2]],
-               cols[3]: mean[cols[3]], cols[4]: mean[cols[4]],
-               cols[5]: mean[cols[5]]}
-        temp = pd.DataFrame(add, index=[0])
-        fmr_data = pd.concat([fmr_data, temp], ignore_index=True)
+    data_types = fmr_data.dtypes
+    fmr_data = fmr_data.groupby(cols[0], as_index=False, sort=False, observed=True).mean(numeric_only=True)
+
+    # rounding up the averaged FMRs, and restoring the datatypes with which they were loaded.
+    fmr_cols = fmr_data.columns[1:]
+    fmr_data[fmr_cols] = np.ceil(fmr_data[fmr_cols]).astype(data_types[fmr_cols].to_dict())
     return fmr_data
 
 
-def merge_area_code_zipcode(fmr_data: pd.DataFrame, file_directory='Data/HUD FMR') -> pd.DataFrame:
+def merge_area_code_zipcode(fmr_data: pd.DataFrame, fmr_file: str) -> pd.DataFrame:
     """
     This function maps each zipcode with the cbsa_code for that metro area to which it belongs.
-    It used the most recent small area fmr file to get the most accurate cbsa_codes for the zipcodes.
+    The most recent small area fmr file should be used to get the most accurate cbsa_codes for the zipcodes.
 
     :param fmr_data: Dataframe containing zipcode level FMR rates for all the years.
-    :param file_directory: Path of the directory containing the small area FMR files.
+    :param fmr_file: Path of the small area FMR file to read the cbsa_codes from.
     :return: Dataframe with cbsa_codes mapped for all the zipcodes.
     """
-    max_year = 0
-    fmr_file_name = glob.glob(file_directory + '/*.csv')
-    map_year = dict()
-
-    # Identifying the most recent file
-    for file in range(len(fmr_file_name)):
-        string = os.path.basename(fmr_file_name[file])
-        string = string.lower()
-        year = re.search('fy\d{4}', string=string).group()
-        year = int(re.sub('\D', '', year))
-        map_year[year] = fmr_file_name[file]
-        if year > max_year:
-            max_year = year
-
-    # Loading the most recent file
-    path = map_year[max_year]
-    codes = pd.read_excel(path, usecols=['ZIP\nCode', 'HUD Area Code'], dtype='string').rename(
-        columns={'ZIP\nCode': 'ZIPCODE', 'HUD Area Code': 'Metro_Codes'})
-
-    # mapping zipcodes with their respective metro areas.
+    # Only reading the two columns that are needed from the file. The codes are stored as arrow backed strings,
+    # which keeps them in contiguous buffers instead of python string objects.
+    codes = pd.read_excel(fmr_file, usecols=['ZIP\nCode', 'HUD Area Code'], dtype='string[pyarrow]',
+                          engine='calamine').rename(columns={'ZIP\nCode': 'ZIPCODE', 'HUD Area Code': 'Metro_Codes'})
+
+    # mapping zipcodes with their respective metro areas, joining on the same arrow backed string type.
+    fmr_data = fmr_data.astype({'ZIPCODE': 'string[pyarrow]'})
     df = pd.merge(fmr_data, codes, how='left', on='ZIPCODE')
 
     return df
@@ -200,5 +213,11 @@ def merge_area_code_zipcode(fmr_data: pd.DataFrame, file_directory='Data/HUD FMR
 
 if __name__ == '__main__':
     zip_data = load_all_fmr_files(file_directory='Data/HUD FMR')
-    zip_data.to_csv('Data/Processed Data/zipcode_fmrs.csv', index=False)
+    # Writing the csv with arrow, which formats the columns in C++ instead of pandas' row by row python writer.
+    # Date is written as a plain date and nothing is quoted, so the file stays the same as the one to_csv wrote.
+    zip_table = pa.Table.from_pandas(zip_data, preserve_index=False)
+    zip_table = zip_table.set_column(zip_table.schema.get_field_index('Date'), 'Date',
+                                     zip_table['Date'].cast(pa.date32()))
+    pacsv.write_csv(zip_table, 'Data/Processed Data/zipcode_fmrs.csv',
+                    write_options=pacsv.WriteOptions(include_header=True, quoting_style='none', quoting_header='none'))
     print('Data Processing Complete')
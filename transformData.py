@@ -4,7 +4,7 @@ into new dataframes, which are better suitable for analysis.
 """
 
 import pandas as pd
-from datetime import datetime
+import numpy as np
 
 
 def transform_cpi_data(df: pd.DataFrame) -> pd.DataFrame:
@@ -24,22 +24,13 @@ def transform_cpi_data(df: pd.DataFrame) -> pd.DataFrame:
     >>> print(test_data_t.shape)
     (37, 1)
     """
-    years = df.index
-    df_t = pd.DataFrame()
+    # Transforming all rows into a single column, with one row for every year and month
+    df_t = df.rename_axis('year').reset_index().melt(id_vars='year', var_name='Month', value_name='CPI')
 
-    # Transforming all rows into a single column
-    for year in range(len(years)):
-        y = pd.DataFrame(df.loc[years[year]])
-        y.reset_index(inplace=True)
-        # Computing date using year and month
-        y['Date'] = y['Month'].apply(lambda x: datetime.strptime(years[year] + ' ' + x, '%Y %m'))
-        y = y.drop(columns=['Month']).set_index('Date').rename(columns={years[year]: 'CPI'})
-        if year == 0:
-            df_t = y.copy()
-        else:
-            df_t = pd.concat([df_t, y], axis=0).dropna()
+    # Computing date using year and month, converting each distinct year-month only once
+    df_t['Date'] = pd.to_datetime(df_t['year'] + '-' + df_t['Month'], format='%Y-%m', cache=True)
 
-    return df_t
+    return df_t.set_index('Date')[['CPI']].dropna().sort_index()
 
 
 def smooth_and_merge(cpi: pd.DataFrame, fmr: pd.DataFrame, start_month: int) -> pd.DataFrame:
@@ -77,12 +68,13 @@ def smooth_and_merge(cpi: pd.DataFrame, fmr: pd.DataFrame, start_month: int) ->
     freq = 'YS-'+month
 
     # https://www.youtube.com/watch?v=PFQme5QfpaI
-    cpi = cpi.groupby(pd.Grouper(freq=freq)).mean()
-    combined = pd.merge(fmr.set_index('Date'), cpi, how='inner', left_index=True, right_index=True)
+    # 'transform_cpi_data' returns the CPI sorted by date, so it can be resampled directly.
+    cpi = cpi.resample(freq).mean()
+    combined = fmr.set_index('Date').join(cpi, how='inner')
 
-    # computing mean rent for the area
-    combined['Mean_Rent'] = combined[['Efficiency', 'One-Bedroom',
-                                      'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom', 'CPI']].mean(axis=1)
+    # computing mean rent for the area, as a row wise mean over a contiguous float32 block
+    rents = combined[['Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom', 'CPI']]
+    combined['Mean_Rent'] = np.nanmean(rents.to_numpy(dtype='float32', na_value=np.nan), axis=1)
 
     return combined[['Efficiency', 'One-Bedroom', 'Two-Bedroom', 'Three-Bedroom', 'Four-Bedroom', 'Mean_Rent', 'CPI']]
 